@@ -2,10 +2,11 @@ from fastapi import FastAPI, Request, Form, BackgroundTasks
 from fastapi.responses import HTMLResponse, JSONResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
+from functools import lru_cache
 from typing import Optional
 
 from .core.config import settings
-from .services.downloader import JobManager
+from .services.downloader import JobManager, classify_url
 
 app = FastAPI(title="TikTok Profile Downloader")
 
@@ -16,12 +17,25 @@ templates = Jinja2Templates(directory=str(settings.TEMPLATES_DIR))
 job_manager = JobManager()
 
 
+def _parse_optional_int(value: Optional[str]) -> Optional[int]:
+    # Campos de formulario vacíos o no numéricos se tratan como "sin límite"
+    if not value:
+        return None
+    s = value.strip()
+    return int(s) if s.isdecimal() else None
+
+
+@lru_cache(maxsize=None)
+def _render(name: str) -> bytes:
+    # Las páginas son estáticas: se renderizan una sola vez y se sirven desde memoria
+    return templates.get_template(name).render({
+        "default_output": str(settings.DEFAULT_OUTPUT_ROOT)
+    }).encode("utf-8")
+
+
 @app.get("/", response_class=HTMLResponse)
 async def index(request: Request):
-    return templates.TemplateResponse("index.html", {
-        "request": request,
-        "default_output": str(settings.DEFAULT_OUTPUT_ROOT)
-    })
+    return HTMLResponse(content=_render("index.html"))
 
 
 @app.post("/api/jobs")
@@ -33,15 +47,7 @@ async def create_job(
     max_videos: Optional[str] = Form(None),
     proxy: Optional[str] = Form(None),
 ):
-    # Normalize and convert max_videos if provided
-    mv: Optional[int] = None
-    if max_videos is not None:
-        s = str(max_videos).strip()
-        if s:
-            try:
-                mv = int(s)
-            except ValueError:
-                mv = None
+    mv = _parse_optional_int(max_videos)
 
     job = job_manager.create_job(
         profile_url=profile_url.strip(),
@@ -49,29 +55,24 @@ async def create_job(
         max_videos=mv,
         proxy=proxy,
     )
-    background_tasks.add_task(job_manager.run_job, job.id)
+    background_tasks.add_task(job_manager.submit_job, job.id)
     return {"job_id": job.id}
 
 
+# Legacy TikTok aliases for /api/tiktok/jobs/{job_id}
 @app.get("/api/jobs/{job_id}")
 async def get_job(job_id: str):
-    job = job_manager.get_job(job_id)
-    if not job:
-        return JSONResponse(status_code=404, content={"detail": "Job not found"})
-    return job.to_dict()
+    return await get_platform_job("tiktok", job_id)
 
 
 @app.post("/api/jobs/{job_id}/cancel")
 async def cancel_job(job_id: str):
-    ok = job_manager.cancel_job(job_id)
-    if not ok:
-        return JSONResponse(status_code=404, content={"detail": "Job not found"})
-    return {"status": "cancelled"}
+    return await cancel_platform_job("tiktok", job_id)
 
 
 @app.get("/features", response_class=HTMLResponse)
 async def features(request: Request):
-    return templates.TemplateResponse("features.html", {"request": request})
+    return HTMLResponse(content=_render("features.html"))
 
 
 # Pricing page removed - using ad-based monetization model
@@ -79,27 +80,27 @@ async def features(request: Request):
 
 @app.get("/support", response_class=HTMLResponse)
 async def support(request: Request):
-    return templates.TemplateResponse("support.html", {"request": request})
+    return HTMLResponse(content=_render("support.html"))
 
 
 @app.get("/login", response_class=HTMLResponse)
 async def login(request: Request):
-    return templates.TemplateResponse("login.html", {"request": request})
+    return HTMLResponse(content=_render("login.html"))
 
 
 @app.get("/youtube", response_class=HTMLResponse)
 async def youtube(request: Request):
-    return templates.TemplateResponse("youtube.html", {"request": request})
+    return HTMLResponse(content=_render("youtube.html"))
 
 
 @app.get("/instagram", response_class=HTMLResponse)
 async def instagram(request: Request):
-    return templates.TemplateResponse("instagram.html", {"request": request})
+    return HTMLResponse(content=_render("instagram.html"))
 
 
 @app.get("/audio", response_class=HTMLResponse)
 async def audio(request: Request):
-    return templates.TemplateResponse("audio.html", {"request": request})
+    return HTMLResponse(content=_render("audio.html"))
 
 
 @app.post("/api/instagram/jobs")
@@ -114,29 +115,23 @@ async def create_instagram_job(
     try:
         # Validate Instagram URL
         url = profile_url.strip()
-        if not url or not ("instagram.com" in url):
+        platform = classify_url(url)
+        if not url or platform != "instagram":
             return JSONResponse(
                 status_code=400, 
                 content={"error": "Por favor ingresa una URL válida de Instagram"}
             )
         
-        # Normalize and convert max_videos if provided
-        mv: Optional[int] = None
-        if max_videos is not None:
-            s = str(max_videos).strip()
-            if s:
-                try:
-                    mv = int(s)
-                except ValueError:
-                    mv = None
+        mv = _parse_optional_int(max_videos)
 
         job = job_manager.create_job(
             profile_url=url,
             output_root=output_root or str(settings.DEFAULT_OUTPUT_ROOT),
             max_videos=mv,
             proxy=None,
+            platform=platform,
         )
-        background_tasks.add_task(job_manager.run_job, job.id)
+        background_tasks.add_task(job_manager.submit_job, job.id)
         return {"job_id": job.id, "message": "Descarga iniciada. Si falla, puede ser por restricciones de la plataforma."}
     
     except Exception as e:
@@ -158,29 +153,23 @@ async def create_youtube_job(
     try:
         # Validate YouTube URL
         url = profile_url.strip()
-        if not url or not ("youtube.com" in url or "youtu.be" in url):
+        platform = classify_url(url)
+        if not url or platform != "youtube":
             return JSONResponse(
                 status_code=400, 
                 content={"error": "Por favor ingresa una URL válida de YouTube"}
             )
         
-        # Normalize and convert max_videos if provided
-        mv: Optional[int] = None
-        if max_videos is not None:
-            s = str(max_videos).strip()
-            if s:
-                try:
-                    mv = int(s)
-                except ValueError:
-                    mv = None
+        mv = _parse_optional_int(max_videos)
 
         job = job_manager.create_job(
             profile_url=url,
             output_root=output_root or str(settings.DEFAULT_OUTPUT_ROOT),
             max_videos=mv,
             proxy=None,
+            platform=platform,
         )
-        background_tasks.add_task(job_manager.run_job, job.id)
+        background_tasks.add_task(job_manager.submit_job, job.id)
         return {"job_id": job.id, "message": "Descarga iniciada. Videos individuales tienen mejor tasa de éxito."}
     
     except Exception as e:
@@ -212,7 +201,7 @@ async def create_audio_job(
             max_videos=1,
             proxy=None,
         )
-        background_tasks.add_task(job_manager.run_job, job.id)
+        background_tasks.add_task(job_manager.submit_job, job.id)
         return {"job_id": job.id, "message": "Extracción iniciada. Algunos contenidos pueden no estar disponibles."}
     
     except Exception as e:
@@ -222,57 +211,28 @@ async def create_audio_job(
         )
 
 
-# Instagram job status and cancel endpoints
-@app.get("/api/instagram/jobs/{job_id}")
-async def get_instagram_job(job_id: str):
-    job = job_manager.get_job(job_id)
-    if not job:
-        return JSONResponse(status_code=404, content={"detail": "Job not found"})
-    return job.to_dict()
+# Job status and cancel endpoints shared by every platform
+_JOB_PLATFORMS = frozenset({"tiktok", "youtube", "instagram", "audio"})
 
 
-@app.post("/api/instagram/jobs/{job_id}/cancel")
-async def cancel_instagram_job(job_id: str):
-    ok = job_manager.cancel_job(job_id)
-    if not ok:
-        return JSONResponse(status_code=404, content={"detail": "Job not found"})
-    return {"status": "cancelled"}
-
-
-# YouTube job status and cancel endpoints
-@app.get("/api/youtube/jobs/{job_id}")
-async def get_youtube_job(job_id: str):
-    job = job_manager.get_job(job_id)
+@app.get("/api/{platform}/jobs/{job_id}")
+async def get_platform_job(platform: str, job_id: str):
+    job = job_manager.get_job(job_id) if platform in _JOB_PLATFORMS else None
     if not job:
         return JSONResponse(status_code=404, content={"detail": "Job not found"})
     return job.to_dict()
 
 
-@app.post("/api/youtube/jobs/{job_id}/cancel")
-async def cancel_youtube_job(job_id: str):
-    ok = job_manager.cancel_job(job_id)
+@app.post("/api/{platform}/jobs/{job_id}/cancel")
+async def cancel_platform_job(platform: str, job_id: str):
+    ok = platform in _JOB_PLATFORMS and job_manager.cancel_job(job_id)
     if not ok:
         return JSONResponse(status_code=404, content={"detail": "Job not found"})
+    if platform == "audio":
+        return {"message": "Job cancelled"}
     return {"status": "cancelled"}
 
 
-# Audio job status and cancel endpoints
-@app.get("/api/audio/jobs/{job_id}")
-async def get_audio_job(job_id: str):
-    job = job_manager.get_job(job_id)
-    if not job:
-        return JSONResponse(status_code=404, content={"detail": "Job not found"})
-    return job.to_dict()
-
-
-@app.post("/api/audio/jobs/{job_id}/cancel")
-async def cancel_audio_job(job_id: str):
-    ok = job_manager.cancel_job(job_id)
-    if not ok:
-        return JSONResponse(status_code=404, content={"detail": "Job not found"})
-    return {"message": "Job cancelled"}
-
-
 @app.post("/api/analytics/ad-impression")
 async def track_ad_impression(request: Request):
     """Track ad impression for analytics"""
@@ -1,25 +1,200 @@
 from __future__ import annotations
 
+import asyncio
+import contextlib
+import re
+import secrets
 import threading
-import uuid
+from concurrent.futures import ThreadPoolExecutor
 import time
 from dataclasses import dataclass, field, asdict
 from pathlib import Path
-from typing import Dict, Optional, List
+from typing import Dict, Optional, List, Set
 
 from loguru import logger
-import yt_dlp
 
 from ..core.config import settings
 
 
-@dataclass
+# Palabras clave que indican rate limit en los mensajes de error de yt-dlp
+_RATELIMIT_RE = re.compile(r"rate|limit|try again later", re.IGNORECASE)
+
+# Intervalo mínimo (segundos) entre actualizaciones de estado por progreso
+_HOOK_MIN_INTERVAL = 0.5
+
+# Plataformas soportadas y los dominios que las identifican. Regex sin
+# distinción de mayúsculas para no tener que crear una copia en minúsculas de la URL
+_YT_RE = re.compile(r"youtube\.com|youtu\.be", re.IGNORECASE)
+_IG_RE = re.compile(r"instagram\.com", re.IGNORECASE)
+_TT_RE = re.compile(r"tiktok\.com", re.IGNORECASE)
+_PLATFORMS = (
+    ("youtube", _YT_RE),
+    ("instagram", _IG_RE),
+    ("tiktok", _TT_RE),
+)
+
+
+def classify_url(url: str) -> str:
+    return next((name for name, pattern in _PLATFORMS if pattern.search(url)), "other")
+
+
+# Opciones base de yt-dlp por plataforma. Se construyen una sola vez al importar
+# el módulo; cada job sólo añade outtmpl, progress_hooks y proxy.
+
+# Configuración específica para Instagram
+_IG_OPTS_BASE = {
+    "noplaylist": True,  # Solo el post específico
+    "format": "best[height<=720]",  # Formato más compatible
+    "merge_output_format": "mp4",
+    "retries": 3,
+    "fragment_retries": 5,
+    "ignoreerrors": True,
+    "quiet": True,
+    "no_warnings": True,
+    # Headers específicos para Instagram
+    "http_headers": {
+        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
+        "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+        "Accept-Language": "en-us,en;q=0.5",
+        "Accept-Encoding": "gzip,deflate",
+        "Accept-Charset": "ISO-8859-1,utf-8;q=0.7,*;q=0.7",
+        "Keep-Alive": "300",
+        "Connection": "keep-alive",
+    },
+    # Configuraciones adicionales para Instagram
+    "extractor_args": {
+        "instagram": {
+            "api_version": "v1"
+        }
+    }
+}
+
+# Configuración específica para YouTube con múltiples fallbacks
+_YT_OPTS_BASE = {
+    "noplaylist": True,
+    "format": "best[height<=720]/best",
+    "merge_output_format": "mp4",
+    "retries": 5,
+    "fragment_retries": 10,
+    "ignoreerrors": True,
+    "quiet": True,
+    "no_warnings": True,
+    # Rate limiting
+    "sleep_interval": 3,
+    "max_sleep_interval": 10,
+    "sleep_interval_requests": 2,
+    # Headers actualizados para 2024
+    "http_headers": {
+        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36",
+        "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7",
+        "Accept-Language": "en-US,en;q=0.9",
+        "Accept-Encoding": "gzip, deflate, br",
+        "Connection": "keep-alive",
+        "Upgrade-Insecure-Requests": "1",
+        "Sec-Fetch-Dest": "document",
+        "Sec-Fetch-Mode": "navigate",
+        "Sec-Fetch-Site": "none",
+        "Sec-Fetch-User": "?1",
+        "sec-ch-ua": '"Chromium";v="122", "Not(A:Brand";v="24", "Google Chrome";v="122"',
+        "sec-ch-ua-mobile": "?0",
+        "sec-ch-ua-platform": '"Windows"',
+    },
+    # Configuraciones avanzadas con múltiples fallbacks
+    "extractor_args": {
+        "youtube": {
+            # Orden de clientes: Android primero (más estable)
+            "player_client": ["android", "android_embedded", "ios", "ios_embedded", "web", "mweb", "tv_embedded"],
+            "player_skip": ["webpage", "configs"],
+            "skip": ["hls"],
+            "comment_sort": ["top"],
+            "max_comments": [0],
+            # Configuraciones adicionales para bypass
+            "include_live_dash": False,
+            "include_hls_manifest": False,
+        }
+    },
+    # Configuraciones adicionales
+    "writesubtitles": False,
+    "writeautomaticsub": False,
+    "writedescription": False,
+    "writeinfojson": False,
+    "writethumbnail": False,
+    "extract_flat": False,
+    # Configuración de cookies y sesión
+    "cookiefile": None,
+    "no_check_certificate": True,
+}
+
+# Configuración para otras plataformas (TikTok, etc.)
+_GENERIC_OPTS_BASE = {
+    "noplaylist": False,
+    "format": "bv*+ba/b",  # best video+audio or best
+    "merge_output_format": "mp4",
+    "concurrent_fragment_downloads": settings.YTDLP_CONCURRENCY,
+    "retries": 5,
+    "fragment_retries": 10,
+    "ignoreerrors": True,
+    "quiet": True,
+    "no_warnings": True,
+}
+
+# Múltiples fallbacks para YouTube
+_YT_FALLBACKS = (
+    # Fallback 1: Solo Android client
+    {
+        "noplaylist": True,
+        "format": "best[height<=480]/best",
+        "ignoreerrors": True,
+        "quiet": True,
+        "no_warnings": True,
+        "extractor_args": {
+            "youtube": {
+                "player_client": ["android"],
+                "player_skip": ["webpage"],
+            }
+        }
+    },
+    # Fallback 2: iOS client únicamente
+    {
+        "noplaylist": True,
+        "format": "worst/best",
+        "ignoreerrors": True,
+        "quiet": True,
+        "no_warnings": True,
+        "extractor_args": {
+            "youtube": {
+                "player_client": ["ios"],
+            }
+        }
+    },
+    # Fallback 3: Configuración mínima
+    {
+        "noplaylist": True,
+        "format": "best",
+        "ignoreerrors": True,
+        "quiet": True,
+        "no_warnings": True,
+    },
+)
+
+# Fallback simple para otras plataformas
+_SIMPLE_OPTS_BASE = {
+    "noplaylist": True,
+    "format": "best",
+    "ignoreerrors": True,
+    "quiet": True,
+    "no_warnings": True,
+}
+
+
+@dataclass(slots=True)
 class Job:
     id: str
     profile_url: str
     output_root: Path
     max_videos: Optional[int] = None
     proxy: Optional[str] = None
+    platform: str = "other"  # youtube|instagram|tiktok|other, ver classify_url
 
     # runtime fields
     status: str = "queued"  # queued|running|completed|cancelled|failed
@@ -30,11 +205,20 @@ class Job:
     message: str = ""
     created_at: float = field(default_factory=lambda: time.time())
     updated_at: float = field(default_factory=lambda: time.time())
-    _cancel_event: threading.Event = field(default_factory=threading.Event, repr=False, compare=False)
+    # Flag de cancelación de un solo sentido; leerlo es atómico bajo el GIL
+    cancelled: bool = field(default=False, repr=False, compare=False)
+    # Protege las transiciones de estado sin bloquear el polling de otros jobs
+    _state_lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+    # Última actualización (reloj monotónico) hecha desde el progress hook
+    _last_hook_time: float = field(default=0.0, repr=False, compare=False)
 
-    def to_dict(self) -> Dict:
+    # Vista persistente para to_dict: se construye una vez y en cada poll
+    # sólo se refrescan los campos que cambian durante la descarga
+    _dict_view: Dict = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
         # Evitar deepcopy de dataclasses.asdict que intenta copiar _thread.lock
-        return {
+        self._dict_view = {
             "id": self.id,
             "profile_url": self.profile_url,
             "output_root": str(self.output_root),
@@ -50,63 +234,123 @@ class Job:
             "updated_at": self.updated_at,
         }
 
+    def to_dict(self) -> Dict:
+        view = self._dict_view
+        view["status"] = self.status
+        view["progress"] = self.progress
+        view["total"] = self.total
+        view["downloaded"] = self.downloaded
+        view["failed"] = self.failed
+        view["message"] = self.message
+        view["updated_at"] = self.updated_at
+        return view
+
 
 class JobManager:
     def __init__(self):
+        # Sin lock global: inserción y lectura en dict son atómicas bajo el GIL y
+        # los IDs son únicos; el estado de cada job lo protege su propio _state_lock
         self._jobs: Dict[str, Job] = {}
-        self._lock = threading.Lock()
+        # Pool dedicado para yt-dlp, así sus descargas bloqueantes no ocupan el
+        # threadpool de FastAPI que atiende las peticiones (p. ej. el polling de estado)
+        self._executor = ThreadPoolExecutor(
+            max_workers=settings.YTDLP_CONCURRENCY, thread_name_prefix="ytdlp"
+        )
+        self._sem = asyncio.Semaphore(settings.YTDLP_CONCURRENCY)
+        self._ensured_dirs: Set[str] = set()
+
+    def _ensure_dir(self, path: Path):
+        # La carpeta por defecto se reutiliza en casi todos los jobs; crearla una sola vez
+        key = str(path)
+        if key in self._ensured_dirs:
+            return
+        path.mkdir(parents=True, exist_ok=True)
+        self._ensured_dirs.add(key)
 
-    def create_job(self, profile_url: str, output_root: str, max_videos: Optional[int], proxy: Optional[str]) -> Job:
-        job_id = str(uuid.uuid4())
+    def create_job(self, profile_url: str, output_root: str, max_videos: Optional[int], proxy: Optional[str], platform: Optional[str] = None) -> Job:
+        job_id = secrets.token_urlsafe(12)
         output_root_path = Path(output_root)
-        output_root_path.mkdir(parents=True, exist_ok=True)
+        self._ensure_dir(output_root_path)
         job = Job(
             id=job_id,
             profile_url=profile_url,
             output_root=output_root_path,
             max_videos=max_videos,
             proxy=proxy,
+            platform=platform or classify_url(profile_url),
         )
-        with self._lock:
-            self._jobs[job_id] = job
+        self._jobs[job_id] = job
         logger.info(f"Created job {job_id} for {profile_url}")
         return job
 
     def get_job(self, job_id: str) -> Optional[Job]:
-        with self._lock:
-            return self._jobs.get(job_id)
+        return self._jobs.get(job_id)
 
     def cancel_job(self, job_id: str) -> bool:
         job = self.get_job(job_id)
         if not job:
             return False
-        job._cancel_event.set()
-        job.status = "cancelled"
-        job.updated_at = time.time()
+        job.cancelled = True
+        with job._state_lock:
+            job.status = "cancelled"
+            job.updated_at = time.time()
         logger.info(f"Cancelled job {job_id}")
         return True
 
+    async def submit_job(self, job_id: str):
+        async with self._sem:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self._executor, self.run_job, job_id)
+
     def run_job(self, job_id: str):
+        # Import perezoso: yt_dlp registra cientos de extractores al importarse y
+        # no hace falta para arrancar el servidor ni para /health
+        import yt_dlp
+
         job = self.get_job(job_id)
-        if not job or job.status == "cancelled":
+        if not job:
             return
-        job.status = "running"
-        job.updated_at = time.time()
+        with job._state_lock:
+            if job.status == "cancelled":
+                return
+            job.status = "running"
+            job.updated_at = time.time()
 
         # Output template: create folder per profile under output_root
         out_dir = job.output_root
-        out_dir.mkdir(parents=True, exist_ok=True)
         outtmpl = str(out_dir / "%(uploader)s/%(upload_date>%Y-%m-%d)s_%(id)s.%(ext)s")
 
+        # URLs de primer nivel que se siguen, y las que yt-dlp reportó como terminadas
+        # (para detectar fallos del lote)
+        tracked_urls: Set[str] = set()
+        finished_urls: Set[str] = set()
+
         # Progress hooks
         def progress_hook(d):
-            if job._cancel_event.is_set():
-                raise yt_dlp.utils.DownloadError("Job cancelled by user")
-            if d.get('status') == 'downloading':
+            if job.cancelled:
+                # DownloadCancelled (a diferencia de DownloadError) no lo absorbe
+                # ignoreerrors, así que corta el lote completo de ydl.download
+                raise yt_dlp.utils.DownloadCancelled("Job cancelled by user")
+            status = d.get('status')
+            if status == 'downloading':
+                # yt-dlp llama al hook por cada chunk; basta con actualizar cada 500ms
+                now = time.monotonic()
+                if now - job._last_hook_time < _HOOK_MIN_INTERVAL:
+                    return
+                job._last_hook_time = now
                 # d may contain 'total_bytes_estimate' or 'total_bytes'
                 job.message = d.get('filename', '')
                 job.updated_at = time.time()
-            elif d.get('status') == 'finished':
+            elif status == 'finished':
+                info_dict = d.get('info_dict') or {}
+                # playlist_webpage_url cubre entradas que resultan ser playlists anidadas
+                # (p. ej. las pestañas de un canal), cuyos videos terminan con su propia URL
+                for key in ('original_url', 'webpage_url', 'playlist_webpage_url'):
+                    u = info_dict.get(key)
+                    if u in tracked_urls:
+                        finished_urls.add(u)
+                if job.total:
+                    job.progress = min(len(finished_urls) / job.total, 1.0)
                 job.downloaded += 1
                 job.message = f"Downloaded {d.get('filename', '')}"
                 job.updated_at = time.time()
@@ -114,224 +358,89 @@ class JobManager:
         # TikTok user URL can be like https://www.tiktok.com/@username
         # yt-dlp will enumerate all videos available (subject to rate limits/privileges)
         url = job.profile_url
+        is_youtube = job.platform == "youtube"
 
-        # Configuración específica para Instagram
-        if "instagram.com" in url.lower():
-            ydl_opts = {
-                "outtmpl": outtmpl,
-                "noplaylist": True,  # Solo el post específico
-                "progress_hooks": [progress_hook],
-                "format": "best[height<=720]",  # Formato más compatible
-                "merge_output_format": "mp4",
-                "retries": 3,
-                "fragment_retries": 5,
-                "ignoreerrors": True,
-                "quiet": True,
-                "no_warnings": True,
-                # Headers específicos para Instagram
-                "http_headers": {
-                    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
-                    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
-                    "Accept-Language": "en-us,en;q=0.5",
-                    "Accept-Encoding": "gzip,deflate",
-                    "Accept-Charset": "ISO-8859-1,utf-8;q=0.7,*;q=0.7",
-                    "Keep-Alive": "300",
-                    "Connection": "keep-alive",
-                },
-                # Configuraciones adicionales para Instagram
-                "extractor_args": {
-                    "instagram": {
-                        "api_version": "v1"
-                    }
-                }
-            }
-        elif "youtube.com" in url.lower() or "youtu.be" in url.lower():
-            # Configuración específica para YouTube con múltiples fallbacks
-            ydl_opts = {
-                "outtmpl": outtmpl,
-                "noplaylist": True,
-                "progress_hooks": [progress_hook],
-                "format": "best[height<=720]/best",
-                "merge_output_format": "mp4",
-                "retries": 5,
-                "fragment_retries": 10,
-                "ignoreerrors": True,
-                "quiet": True,
-                "no_warnings": True,
-                # Rate limiting
-                "sleep_interval": 3,
-                "max_sleep_interval": 10,
-                "sleep_interval_requests": 2,
-                # Headers actualizados para 2024
-                "http_headers": {
-                    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36",
-                    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7",
-                    "Accept-Language": "en-US,en;q=0.9",
-                    "Accept-Encoding": "gzip, deflate, br",
-                    "Connection": "keep-alive",
-                    "Upgrade-Insecure-Requests": "1",
-                    "Sec-Fetch-Dest": "document",
-                    "Sec-Fetch-Mode": "navigate",
-                    "Sec-Fetch-Site": "none",
-                    "Sec-Fetch-User": "?1",
-                    "sec-ch-ua": '"Chromium";v="122", "Not(A:Brand";v="24", "Google Chrome";v="122"',
-                    "sec-ch-ua-mobile": "?0",
-                    "sec-ch-ua-platform": '"Windows"',
-                },
-                # Configuraciones avanzadas con múltiples fallbacks
-                "extractor_args": {
-                    "youtube": {
-                        # Orden de clientes: Android primero (más estable)
-                        "player_client": ["android", "android_embedded", "ios", "ios_embedded", "web", "mweb", "tv_embedded"],
-                        "player_skip": ["webpage", "configs"],
-                        "skip": ["hls"],
-                        "comment_sort": ["top"],
-                        "max_comments": [0],
-                        # Configuraciones adicionales para bypass
-                        "include_live_dash": False,
-                        "include_hls_manifest": False,
-                    }
-                },
-                # Configuraciones adicionales
-                "writesubtitles": False,
-                "writeautomaticsub": False,
-                "writedescription": False,
-                "writeinfojson": False,
-                "writethumbnail": False,
-                "extract_flat": False,
-                # Configuración de cookies y sesión
-                "cookiefile": None,
-                "no_check_certificate": True,
-            }
-        else:
-            # Configuración para otras plataformas (TikTok, etc.)
-            ydl_opts = {
-                "outtmpl": outtmpl,
-                "noplaylist": False,
-                "progress_hooks": [progress_hook],
-                "format": "bv*+ba/b",  # best video+audio or best
-                "merge_output_format": "mp4",
-                "concurrent_fragment_downloads": settings.YTDLP_CONCURRENCY,
-                "retries": 5,
-                "fragment_retries": 10,
-                "ignoreerrors": True,
-                "quiet": True,
-                "no_warnings": True,
-            }
+        job_opts = {"outtmpl": outtmpl, "progress_hooks": [progress_hook]}
         if job.proxy:
-            ydl_opts["proxy"] = job.proxy
+            job_opts["proxy"] = job.proxy
+
+        if job.platform == "instagram":
+            ydl_opts = {**_IG_OPTS_BASE, **job_opts}
+        elif is_youtube:
+            ydl_opts = {**_YT_OPTS_BASE, **job_opts}
+        else:
+            ydl_opts = {**_GENERIC_OPTS_BASE, **job_opts}
+
+        def extract_entries(inst):
+            # Listado plano: sólo id + url por entrada; la extracción completa de
+            # cada video la hace ydl.download más adelante, de forma perezosa
+            prev = inst.params.get("extract_flat", False)
+            inst.params["extract_flat"] = "in_playlist"
+            try:
+                return inst.extract_info(url, download=False)
+            finally:
+                inst.params["extract_flat"] = prev
 
         try:
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                # Pre-extract to count entries (optional; may be heavy). We'll stream instead.
+            # Todas las instancias de YoutubeDL del job (principal y fallbacks) se
+            # cierran juntas. Los fallbacks sólo se usan para extraer la info; las
+            # descargas siempre usan la instancia principal (formato, reintentos, headers).
+            with contextlib.ExitStack() as stack:
+                ydl = stack.enter_context(yt_dlp.YoutubeDL(ydl_opts))
+                # Pre-extract (flat) to count entries.
                 # If max_videos provided, we limit by slicing the entries.
                 info = None
                 try:
-                    info = ydl.extract_info(url, download=False)
+                    info = extract_entries(ydl)
                 except Exception as extract_error:
                     logger.warning(f"First extraction failed: {extract_error}. Trying fallback methods...")
                     info = None
                     
-                    # Múltiples fallbacks para YouTube
-                    if "youtube.com" in url.lower() or "youtu.be" in url.lower():
-                        fallback_configs = [
-                            # Fallback 1: Solo Android client
-                            {
-                                "outtmpl": outtmpl,
-                                "noplaylist": True,
-                                "progress_hooks": [progress_hook],
-                                "format": "best[height<=480]/best",
-                                "ignoreerrors": True,
-                                "quiet": True,
-                                "no_warnings": True,
-                                "extractor_args": {
-                                    "youtube": {
-                                        "player_client": ["android"],
-                                        "player_skip": ["webpage"],
-                                    }
-                                }
-                            },
-                            # Fallback 2: iOS client únicamente
-                            {
-                                "outtmpl": outtmpl,
-                                "noplaylist": True,
-                                "progress_hooks": [progress_hook],
-                                "format": "worst/best",
-                                "ignoreerrors": True,
-                                "quiet": True,
-                                "no_warnings": True,
-                                "extractor_args": {
-                                    "youtube": {
-                                        "player_client": ["ios"],
-                                    }
-                                }
-                            },
-                            # Fallback 3: Configuración mínima
-                            {
-                                "outtmpl": outtmpl,
-                                "noplaylist": True,
-                                "progress_hooks": [progress_hook],
-                                "format": "best",
-                                "ignoreerrors": True,
-                                "quiet": True,
-                                "no_warnings": True,
-                            }
-                        ]
-                        
-                        for i, fallback_opts in enumerate(fallback_configs, 1):
+                    if is_youtube:
+                        for i, fallback_base in enumerate(_YT_FALLBACKS, 1):
                             try:
-                                if job.proxy:
-                                    fallback_opts["proxy"] = job.proxy
-                                
+                                fallback_opts = {**fallback_base, **job_opts}
                                 logger.info(f"Trying YouTube fallback {i}/3...")
                                 job.message = f"Reintentando con método alternativo {i}/3..."
                                 job.updated_at = time.time()
                                 
-                                with yt_dlp.YoutubeDL(fallback_opts) as fallback_ydl:
-                                    info = fallback_ydl.extract_info(url, download=False)
-                                    if info:
-                                        logger.info(f"YouTube fallback {i} successful!")
-                                        break
+                                fallback_ydl = stack.enter_context(yt_dlp.YoutubeDL(fallback_opts))
+                                info = extract_entries(fallback_ydl)
+                                if info:
+                                    logger.info(f"YouTube fallback {i} successful!")
+                                    break
                             except Exception as fallback_error:
                                 logger.warning(f"YouTube fallback {i} failed: {fallback_error}")
                                 continue
                     else:
                         # Fallback simple para otras plataformas
                         try:
-                            simple_opts = {
-                                "outtmpl": outtmpl,
-                                "noplaylist": True,
-                                "progress_hooks": [progress_hook],
-                                "format": "best",
-                                "ignoreerrors": True,
-                                "quiet": True,
-                                "no_warnings": True,
-                            }
-                            if job.proxy:
-                                simple_opts["proxy"] = job.proxy
-                            
-                            with yt_dlp.YoutubeDL(simple_opts) as simple_ydl:
-                                info = simple_ydl.extract_info(url, download=False)
+                            simple_opts = {**_SIMPLE_OPTS_BASE, **job_opts}
+                            simple_ydl = stack.enter_context(yt_dlp.YoutubeDL(simple_opts))
+                            info = extract_entries(simple_ydl)
                         except Exception as simple_error:
                             logger.error(f"Simple fallback also failed: {simple_error}")
                             info = None
                 
                 if info is None:
                     # Mensaje específico para errores de extracción de YouTube
-                    if "youtube.com" in url.lower() or "youtu.be" in url.lower():
-                        job.status = "failed"
-                        job.message = "⚠️ YouTube ha actualizado su sistema. Intenta actualizar yt-dlp con: pip install -U yt-dlp"
-                        job.updated_at = time.time()
+                    if is_youtube:
+                        with job._state_lock:
+                            job.status = "failed"
+                            job.message = "⚠️ YouTube ha actualizado su sistema. Intenta actualizar yt-dlp con: pip install -U yt-dlp"
+                            job.updated_at = time.time()
                         logger.error(f"Job {job.id} failed: YouTube extraction failed, may need yt-dlp update")
                     else:
-                        job.status = "failed"
-                        job.message = "No se pudo acceder al contenido. Posibles causas: video privado, restringido por región, eliminado, o URL incorrecta."
-                        job.updated_at = time.time()
+                        with job._state_lock:
+                            job.status = "failed"
+                            job.message = "No se pudo acceder al contenido. Posibles causas: video privado, restringido por región, eliminado, o URL incorrecta."
+                            job.updated_at = time.time()
                         logger.error(f"Job {job.id} failed: No info extracted from {url}")
                     return
 
                 entries: List[Dict] = []
-                if "entries" in info and isinstance(info["entries"], list):
+                is_playlist = "entries" in info and isinstance(info["entries"], list)
+                if is_playlist:
                     # Some extractors return a flat list
                     entries = [e for e in info["entries"] if e]
                 else:
@@ -345,14 +454,50 @@ class JobManager:
                 job.progress = 0.0
                 job.updated_at = time.time()
 
-                for idx, entry in enumerate(entries, start=1):
-                    if job._cancel_event.is_set():
-                        raise yt_dlp.utils.DownloadError("Cancelled")
-                    vid_url = entry.get("webpage_url") or entry.get("url")
-                    if not vid_url:
-                        job.failed += 1
+                # Entradas planas con ie_key: su url puede no ser una página válida por
+                # sí sola (yt-dlp caería al extractor genérico), así que se resuelven con
+                # su propio extractor mediante process_ie_result
+                urls: List[str] = []
+                keyed: Dict[str, Dict] = {}
+                for e in entries:
+                    if e.get("_type") == "playlist":
+                        # Playlists ya resueltas: se descargan en el lote pero no entran
+                        # en el seguimiento por URL ni en los reintentos
                         continue
-                    
+                    if e.get("_type") == "url" and e.get("ie_key") and e.get("url"):
+                        keyed[e["url"]] = e
+                        urls.append(e["url"])
+                    elif e.get("webpage_url") or e.get("url"):
+                        urls.append(e.get("webpage_url") or e.get("url"))
+                    else:
+                        job.failed += 1
+                tracked_urls.update(urls)
+
+                def download_entry(vid_url: str):
+                    entry = keyed.get(vid_url)
+                    if entry is not None:
+                        ydl.process_ie_result(dict(entry), download=True)
+                    else:
+                        ydl.download([vid_url])
+
+                # Ruta principal: un solo process_ie_result con todo el lote (el playlist
+                # plano ya recortado a max_videos), que conserva el ie_key de cada entrada
+                batch = {**info, "entries": entries} if is_playlist else info
+                try:
+                    ydl.process_ie_result(batch, download=True)
+                except yt_dlp.utils.DownloadError as e:
+                    logger.warning(f"Batch download interrupted: {e}")
+
+                # Sólo las URLs que el hook no vio terminar pasan al bucle de reintentos
+                pending = [u for u in urls if u not in finished_urls]
+                done = job.total - len(pending)
+                job.progress = done / job.total if job.total else 0.0
+                job.updated_at = time.time()
+
+                for vid_url in pending:
+                    if job.cancelled:
+                        raise yt_dlp.utils.DownloadError("Cancelled")
+
                     # Retry logic with exponential backoff for rate limits
                     max_retries = 3
                     retry_delay = 5  # Start with 5 seconds
@@ -367,42 +512,45 @@ class JobManager:
                                 job.updated_at = time.time()
                                 time.sleep(wait_time)
                             
-                            ydl.download([vid_url])
+                            download_entry(vid_url)
                             break  # Success, exit retry loop
                             
+                        except yt_dlp.utils.DownloadCancelled:
+                            raise
                         except yt_dlp.utils.DownloadError as e:
-                            error_msg = str(e).lower()
-                            if "rate" in error_msg or "limit" in error_msg or "try again later" in error_msg:
+                            if _RATELIMIT_RE.search(str(e)):
                                 if attempt < max_retries - 1:
                                     logger.warning(f"Rate limit detected for {vid_url}, attempt {attempt + 1}/{max_retries}")
                                     continue  # Retry
                                 else:
                                     logger.error(f"Max retries exceeded for rate limit: {vid_url}")
-                                    job.failed += 1
                                     job.message = f"Video bloqueado por rate limit después de {max_retries} intentos"
                             else:
                                 logger.exception(f"Download failed for {vid_url}: {e}")
-                                job.failed += 1
                                 break  # Don't retry for non-rate-limit errors
                         except Exception as e:
                             logger.exception(f"Download failed for {vid_url}: {e}")
-                            job.failed += 1
                             break  # Don't retry for unexpected errors
                     
-                    # Additional delay between videos to prevent rate limiting
-                    if "youtube.com" in url.lower() or "youtu.be" in url.lower():
-                        time.sleep(2)  # 2 second delay between YouTube videos
-                    
-                    job.progress = idx / job.total if job.total else 0.0
+                    done += 1
+                    job.progress = done / job.total if job.total else 0.0
                     job.updated_at = time.time()
 
-            if job.status != "cancelled":
-                job.status = "completed"
-                job.message = f"Done. Downloaded={job.downloaded}, Failed={job.failed}"
-                job.updated_at = time.time()
+                # Con ignoreerrors yt-dlp absorbe los errores de descarga: lo que el hook
+                # no vio terminar tampoco en el reintento cuenta como fallido
+                job.failed += sum(1 for u in pending if u not in finished_urls)
+
+            with job._state_lock:
+                if job.status != "cancelled":
+                    job.status = "completed"
+                    job.message = f"Done. Downloaded={job.downloaded}, Failed={job.failed}"
+                    job.updated_at = time.time()
         except Exception as e:
-            if job.status != "cancelled":
-                job.status = "failed"
-                job.message = str(e)
-                job.updated_at = time.time()
+            with job._state_lock:
+                failed = job.status != "cancelled"
+                if failed:
+                    job.status = "failed"
+                    job.message = str(e)
+                    job.updated_at = time.time()
+            if failed:
                 logger.exception(f"Job {job.id} failed: {e}")
\ No newline at end of file